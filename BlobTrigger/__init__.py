@@ -1,79 +1,260 @@
 import azure.functions as func
+import asyncio
 import logging
 import os
 from datetime import datetime, date
 import uuid
+import threading
+import time
+from collections import OrderedDict
 # --- CAMBIO CLAVE 1: Usar PyMySQL en lugar de mysql.connector ---
 import pymysql
+from dbutils.pooled_db import PooledDB
 
 # --- IMPORTACIONES NECESARIAS PARA DOCUMENT INTELLIGENCE ---
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+# Clientes asíncronos: el worker puede procesar otros blobs mientras espera a DI
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
 from azure.core.credentials import AzureKeyCredential
 # --- FIN IMPORTACIONES NECESARIAS ---
 
 # --- IMPORTACIONES NECESARIAS PARA COSMOS DB ---
-from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosResourceNotFoundError
 # --- FIN IMPORTACIONES NECESARIAS ---
 
+# --- CONFIGURACIÓN LEÍDA UNA SOLA VEZ AL CARGAR EL MÓDULO ---
+# Si falta alguna variable la función falla al arrancar en lugar de en cada ejecución.
+_REQUIRED_SETTINGS = (
+    "DI_ENDPOINT", "DI_KEY",
+    "COSMOS_ENDPOINT", "COSMOS_KEY", "COSMOS_DATABASE_NAME", "COSMOS_CONTAINER_NAME",
+)
+_missing_settings = [name for name in _REQUIRED_SETTINGS if not os.environ.get(name)]
+if _missing_settings:
+    raise RuntimeError(f"Missing required environment variables: {', '.join(_missing_settings)}")
+
+_DI_ENDPOINT = os.environ["DI_ENDPOINT"]
+_DI_KEY = os.environ["DI_KEY"]
+_COSMOS_ENDPOINT = os.environ["COSMOS_ENDPOINT"]
+_COSMOS_KEY = os.environ["COSMOS_KEY"]
+_COSMOS_DATABASE_NAME = os.environ["COSMOS_DATABASE_NAME"]
+_COSMOS_CONTAINER_NAME = os.environ["COSMOS_CONTAINER_NAME"]
+
+# MySQL es opcional: sólo se usa si la metadata del blob no trae el username
+_MYSQL_HOST = os.environ.get("MYSQL_HOST")
+_MYSQL_USER = os.environ.get("MYSQL_USER")
+_MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD")
+_MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE")
+_MYSQL_SSL_CA_PATH = os.environ.get("DB_SSL_CA_PATH") # Opcional: ruta del certificado
+_MYSQL_CONFIGURED = all([_MYSQL_HOST, _MYSQL_USER, _MYSQL_PASSWORD, _MYSQL_DATABASE])
+if not _MYSQL_CONFIGURED:
+    logging.warning("Missing MySQL environment variables. Usernames will only be read from blob metadata.")
+
+# --- CLIENTES GLOBALES REUTILIZADOS ENTRE EJECUCIONES ---
+# Se crean una sola vez por worker para reutilizar las conexiones HTTP/TCP.
+_di_client = None
+_cosmos_container = None
+_cosmos_partition_key_paths = None
+_clients_lock = threading.Lock()
+
+def get_di_client():
+    """
+    Devuelve el cliente de Document Intelligence, creándolo en el primer uso.
+    """
+    global _di_client
+    if _di_client is None:
+        with _clients_lock:
+            if _di_client is None:
+                _di_client = DocumentIntelligenceClient(
+                    endpoint=_DI_ENDPOINT,
+                    credential=AzureKeyCredential(_DI_KEY),
+                    api_version="2024-02-29-preview"
+                )
+    return _di_client
+
+def get_cosmos_container():
+    """
+    Devuelve el cliente del contenedor de Cosmos DB, creándolo en el primer uso.
+    """
+    global _cosmos_container
+    if _cosmos_container is None:
+        with _clients_lock:
+            if _cosmos_container is None:
+                # La consistencia sólo afecta a las lecturas: aquí, a la lectura puntual que detecta duplicados.
+                # Con Eventual esa lectura no depende del session token, pero puede no ver un recibo recién
+                # guardado; ese caso termina en el conflicto de create_item, que ya se maneja.
+                client = CosmosClient(_COSMOS_ENDPOINT, credential=_COSMOS_KEY, consistency_level="Eventual")
+                database = client.get_database_client(_COSMOS_DATABASE_NAME)
+                _cosmos_container = database.get_container_client(_COSMOS_CONTAINER_NAME)
+    return _cosmos_container
+
+# --- POOL GLOBAL DE CONEXIONES MYSQL ---
+# Lock propio: crear el pool abre una conexión TLS y no debe bloquear a los clientes de DI y Cosmos,
+# que se obtienen desde el event loop.
+_mysql_pool = None
+_mysql_pool_lock = threading.Lock()
+
+def get_mysql_pool():
+    """
+    Devuelve el pool de conexiones MySQL, creándolo en el primer uso.
+    """
+    global _mysql_pool
+    if _mysql_pool is None:
+        with _mysql_pool_lock:
+            if _mysql_pool is None:
+                # Las conexiones cerradas vuelven al pool en lugar de cerrar el socket TLS
+                _mysql_pool = PooledDB(
+                    creator=pymysql,
+                    mincached=1,
+                    maxcached=4,
+                    maxconnections=8,
+                    blocking=True,
+                    ping=1, # Verificar la conexión antes de reutilizarla
+                    user=_MYSQL_USER,
+                    password=_MYSQL_PASSWORD,
+                    host=_MYSQL_HOST,
+                    database=_MYSQL_DATABASE,
+                    ssl={'ca': _MYSQL_SSL_CA_PATH} if _MYSQL_SSL_CA_PATH else True # Usar certificado si está definido
+                )
+    return _mysql_pool
+
+# --- CACHÉ EN MEMORIA DE USERNAMES ---
+# Consulta constante: PyMySQL no soporta sentencias preparadas del lado del servidor.
+_USERNAME_QUERY = "SELECT username FROM users WHERE id = %s"
+_USERNAME_CACHE_MAXSIZE = 1024
+_USERNAME_CACHE_TTL_SECONDS = 300
+_username_cache = OrderedDict() # user_id -> (timestamp, username)
+_username_cache_lock = threading.Lock()
+
+def _get_cached_username(user_id):
+    """
+    Devuelve el username en caché si existe y no ha expirado.
+    """
+    with _username_cache_lock:
+        entry = _username_cache.get(user_id)
+        if entry is None:
+            return None
+        cached_at, username = entry
+        if time.monotonic() - cached_at > _USERNAME_CACHE_TTL_SECONDS:
+            del _username_cache[user_id]
+            return None
+        _username_cache.move_to_end(user_id)
+        return username
+
+def _cache_username(user_id, username):
+    """
+    Guarda el username en caché, descartando el menos usado si se supera el tamaño máximo.
+    """
+    with _username_cache_lock:
+        _username_cache[user_id] = (time.monotonic(), username)
+        _username_cache.move_to_end(user_id)
+        if len(_username_cache) > _USERNAME_CACHE_MAXSIZE:
+            _username_cache.popitem(last=False)
+
 # --- FUNCIÓN AUXILIAR PARA OBTENER USERNAME DE MYSQL ---
 def get_username_from_db(user_id):
     """
     Obtiene el nombre de usuario desde la base de datos MySQL usando el user_id.
+    Los resultados encontrados se guardan en caché durante unos minutos.
     """
-    username = None
+    if not _MYSQL_CONFIGURED:
+        return None
+
+    username = _get_cached_username(user_id)
+    if username is not None:
+        logging.info("Username '%s' found in cache for user ID '%s'.", username, user_id)
+        return username
+
     try:
-        # Obtener credenciales de las variables de entorno
-        mysql_host = os.environ.get("MYSQL_HOST")
-        mysql_user = os.environ.get("MYSQL_USER")
-        mysql_password = os.environ.get("MYSQL_PASSWORD")
-        mysql_database = os.environ.get("MYSQL_DATABASE")
-        mysql_ssl_ca_path = os.environ.get("DB_SSL_CA_PATH") # Nueva línea para leer la ruta del certificado
-
-        if not all([mysql_host, mysql_user, mysql_password, mysql_database]):
-            logging.error("Missing MySQL environment variables.")
-            return None
+        mysql_pool = get_mysql_pool()
 
-        # --- CAMBIO CLAVE 2: Usar pymysql.connect() con SSL ---
-        # Conectar a la base de datos
-        cnx = pymysql.connect(
-            user=mysql_user,
-            password=mysql_password,
-            host=mysql_host,
-            database=mysql_database,
-            ssl={'ca': mysql_ssl_ca_path} if mysql_ssl_ca_path else True # Usar certificado si está definido
-        )
-        cursor = cnx.cursor()
+        # Tomar una conexión del pool; al salir del 'with' se devuelve al pool
+        with mysql_pool.connection() as cnx:
+            with cnx.cursor() as cursor:
+                # Ejecutar consulta
+                cursor.execute(_USERNAME_QUERY, (user_id,))
 
-        # Ejecutar consulta
-        query = "SELECT username FROM users WHERE id = %s"
-        cursor.execute(query, (user_id,))
+                # Obtener resultado
+                result = cursor.fetchone()
 
-        # Obtener resultado
-        result = cursor.fetchone()
         if result:
             username = result[0]
-            logging.info(f"Username '{username}' found for user ID '{user_id}'.")
+            _cache_username(user_id, username)
+            logging.info("Username '%s' found for user ID '%s'.", username, user_id)
         else:
-            logging.warning(f"No username found for user ID '{user_id}'.")
+            logging.warning("No username found for user ID '%s'.", user_id)
 
     # --- CAMBIO CLAVE 3: Capturar el error específico de PyMySQL ---
     except pymysql.MySQLError as err:
-        logging.error(f"Error connecting to MySQL or fetching data: {err}")
+        logging.error("Error connecting to MySQL or fetching data: %s", err)
         return None
-    
-    finally:
-        # --- CAMBIO CLAVE: Cambiar la forma de cerrar la conexión para PyMySQL ---
-        # El bloque 'with' es la forma más robusta, pero podemos simplemente cerrarla si existe.
-        if cnx is not None:
-            # Los cursores en PyMySQL no necesitan ser cerrados por separado si se cierra la conexión
-            # Pero cerrarlo no hace daño.
-            if 'cursor' in locals() and cursor is not None:
-                cursor.close()
-            cnx.close()
-            logging.info("MySQL connection closed.")
-            
+
     return username
 
+# --- FUNCIÓN AUXILIAR PARA DETECTAR EVENTOS DUPLICADOS ---
+async def get_cosmos_partition_key_paths(container):
+    """
+    Devuelve las rutas de la partition key del contenedor, leídas una sola vez por worker.
+    """
+    global _cosmos_partition_key_paths
+    if _cosmos_partition_key_paths is None:
+        container_properties = await container.read()
+        _cosmos_partition_key_paths = container_properties["partitionKey"]["paths"]
+    return _cosmos_partition_key_paths
+
+async def receipt_already_processed(container, receipt_fields):
+    """
+    Comprueba con una lectura puntual si el recibo ya fue guardado en Cosmos DB.
+    'receipt_fields' contiene los campos del documento conocidos antes del análisis.
+    """
+    try:
+        # No se asume la partition key: se toma del contenedor y se resuelve con los campos del recibo
+        partition_key_paths = await get_cosmos_partition_key_paths(container)
+        field_names = [path.lstrip('/') for path in partition_key_paths]
+        if any('/' in name or name not in receipt_fields for name in field_names):
+            logging.warning("Duplicate check skipped: partition key %s is not known before analysis.", partition_key_paths)
+            return False
+        partition_key_values = [receipt_fields[name] for name in field_names]
+        partition_key = partition_key_values[0] if len(partition_key_values) == 1 else partition_key_values
+
+        await container.read_item(receipt_fields["id"], partition_key=partition_key)
+        return True
+    except CosmosResourceNotFoundError:
+        return False
+    except Exception as e:
+        # Ante cualquier otro error se procesa el blob igualmente
+        logging.warning("Could not check for an existing receipt %s: %s", receipt_fields["id"], e)
+        return False
+
+# --- EXTRACTORES POR TIPO DE DOCUMENTFIELD ---
+# Se consulta 'field.type' una sola vez en lugar de probar cada atributo con hasattr.
+_EXTRACTORS = {
+    "string": lambda f: f.value_string,
+    "number": lambda f: f.value_number,
+    "date": lambda f: f.value_date.isoformat() if f.value_date else None, # Formatear fecha
+    "time": lambda f: f.value_time.isoformat(timespec='seconds') if f.value_time else None, # Formatear hora
+    "currency": lambda f: f.value_currency.amount if f.value_currency else None,
+}
+
+# --- CAMPOS DEL RECIBO: (nombre en Document Intelligence, nombre en Cosmos DB) ---
+_TOP_FIELDS = (
+    ("NombreComercio", "nombreComercio"),
+    ("RIF-comercio", "rifComercio"),
+    ("FacturaNumero", "facturaNumero"),
+    ("NombreRazon", "nombreRazon"),
+    ("RIF-CI", "rifCI"),
+    ("MontoExento", "montoExento"),
+    ("MontoIVA", "montoIVA"),
+    ("BaseImponible", "baseImponible"),
+)
+
+_ITEM_FIELDS = (
+    ("Description", "description"),
+    ("Quantity", "quantity"),
+    ("TotalPrice", "totalPrice"),
+    ("UnitPrice", "unitPrice"),
+)
+
 # --- FUNCIÓN AUXILIAR REVERTIDA A LA ORIGINAL (SIN CONFIDENCE ANIDADA) ---
 def get_field_value(field):
     """
@@ -81,20 +262,10 @@ def get_field_value(field):
     """
     if field is None:
         return None
-    if hasattr(field, 'value_string') and field.value_string is not None:
-        return field.value_string
-    if hasattr(field, 'value_number') and field.value_number is not None:
-        return field.value_number
-    if hasattr(field, 'value_date') and field.value_date is not None:
-        return field.value_date.strftime('%Y-%m-%d') # Formatear fecha
-    if hasattr(field, 'value_time') and field.value_time is not None:
-        return field.value_time.strftime('%H:%M:%S') # Formatear hora
-    if hasattr(field, 'value_currency') and field.value_currency is not None:
-        if hasattr(field.value_currency, 'amount') and field.value_currency.amount is not None:
-            return field.value_currency.amount
-    if hasattr(field, 'value') and field.value is not None:
-        return field.value
-    return None
+    extractor = _EXTRACTORS.get(field.type)
+    if extractor is not None:
+        return extractor(field)
+    return getattr(field, 'value', None)
 
 # --- NUEVA FUNCIÓN AUXILIAR PARA OBTENER SÓLO LA CONFIANZA ---
 def get_field_confidence(field):
@@ -105,195 +276,167 @@ def get_field_confidence(field):
         return None
     return field.confidence if hasattr(field, 'confidence') else None
 
-def main(myblob: func.InputStream):
+async def main(myblob: func.InputStream):
     logging.info("--- FUNCTION STARTED ---")
 
     # Ignorar archivos placeholder para evitar procesamiento innecesario
     if myblob.name.endswith('/.placeholder'):
-        logging.info(f"Ignoring placeholder file: {myblob.name}")
+        logging.info("Ignoring placeholder file: %s", myblob.name)
         return
 
     user_id = None
     random_subdirectory = None
     try:
-        blob_path_parts = myblob.name.split('/')
+        # Ruta: contenedor/{id}/{random_subdirectory}/{name}; sólo se separan las primeras partes
+        blob_path_parts = myblob.name.split('/', 3)
         if len(blob_path_parts) > 3:
             user_id = blob_path_parts[1]
             random_subdirectory = blob_path_parts[2]
         else:
-            logging.error(f"Could not extract user ID and directory from blob path: {myblob.name}")
+            logging.error("Could not extract user ID and directory from blob path: %s", myblob.name)
             return
     except Exception as e:
-        logging.error(f"Error extracting user ID and directory from blob name: {e}")
+        logging.error("Error extracting user ID and directory from blob name: %s", e)
         return
 
-    logging.info(f"Processing blob for user ID: {user_id}. Directory: {random_subdirectory}. Blob name: {myblob.name}")
+    logging.info("Processing blob for user ID: %s. Directory: %s. Blob name: %s", user_id, random_subdirectory, myblob.name)
+
+    # --- 1. Evitar reprocesar eventos duplicados del mismo blob ---
+    # El ID del documento se deriva de la ruta del blob, así un reintento produce el mismo ID
+    receipt_document_id = str(uuid.uuid5(uuid.NAMESPACE_URL, myblob.name))
+
+    container = get_cosmos_container()
+
+    receipt_fields = {
+        "id": receipt_document_id,
+        "userId": user_id,
+        "directorio": random_subdirectory,
+        "blobURL": myblob.uri,
+    }
+    if await receipt_already_processed(container, receipt_fields):
+        logging.info("Receipt %s already processed for blob %s. Skipping.", receipt_document_id, myblob.name)
+        return
 
-    # --- OBTENER USERNAME DE MYSQL ---
+    # --- OBTENER USERNAME (METADATA DEL BLOB O MYSQL) ---
     # --- CAMBIO CLAVE 4: Inicializar 'username' para evitar el warning de Pylance ---
     username = None 
-    username = get_username_from_db(user_id)
+    # Si el cliente que sube el archivo guarda el username en la metadata del blob, no hace falta consultar MySQL
+    blob_metadata = myblob.metadata or {}
+    username = blob_metadata.get("username")
+    if username is None and _MYSQL_CONFIGURED:
+        # La consulta a MySQL es bloqueante; se ejecuta en un hilo para no frenar el event loop
+        username = await asyncio.to_thread(get_username_from_db, user_id)
     if username is None:
         # Aquí puedes decidir si quieres detener la ejecución o continuar sin el username
-        logging.warning(f"Proceeding without username for user ID: {user_id}")
+        logging.warning("Proceeding without username for user ID: %s", user_id)
 
 
     blob_url = myblob.uri
-    logging.info(f"Processing blob from URL: {blob_url}")
+    logging.info("Processing blob from URL: %s", blob_url)
 
-    doc_int_endpoint = os.environ.get("DI_ENDPOINT")
-    doc_int_key = os.environ.get("DI_KEY")
-
-    if not all([doc_int_endpoint, doc_int_key]):
-        logging.error("Missing Document Intelligence endpoint or key environment variables.")
-        return
+    doc_intelligence_client = get_di_client()
 
     fecha_transaccion = None
     monto_total = None
     extracted_items = []
     full_receipt_data = {}
 
-    item_confidences = []
+    # Suma y conteo acumulados para el promedio de confianza de los items
+    confidence_sum = 0.0
+    confidence_count = 0
 
     try:
-        doc_intelligence_client = DocumentIntelligenceClient(
-            endpoint=doc_int_endpoint,
-            credential=AzureKeyCredential(doc_int_key),
-            api_version="2024-02-29-preview"
-        )
-
-        blob_content = myblob.read()
-
-        poller = doc_intelligence_client.begin_analyze_document(
-            "TrainingHard1", blob_content, content_type="application/octet-stream"
+        # Document Intelligence descarga el blob directamente desde Storage;
+        # requiere que el servicio tenga acceso al blob (identidad administrada o SAS).
+        # Nota: el binding blobTrigger igualmente entrega el contenido del blob al worker dentro
+        # de 'myblob'; se mantiene porque es la única vía que trae la metadata (username) sin
+        # otra llamada de red. Aquí sólo se evita volver a subirlo.
+        poller = await doc_intelligence_client.begin_analyze_document(
+            "TrainingHard1", AnalyzeDocumentRequest(url_source=blob_url),
+            polling_interval=1 # Revisar el estado cada segundo para despertar antes
         )
-        receipt_result = poller.result()
+        receipt_result = await poller.result()
 
-        logging.info(f"Raw DI Result Documents: {receipt_result.documents}")
+        logging.debug("Raw DI Result Documents: %s", receipt_result.documents)
 
         if receipt_result.documents:
             for doc in receipt_result.documents:
 
-                if "FechaTransaccion" in doc.fields:
-                    fecha_transaccion = get_field_value(doc.fields["FechaTransaccion"])
+                fecha_field = doc.fields.get("FechaTransaccion")
+                if fecha_field is not None:
+                    fecha_transaccion = get_field_value(fecha_field)
                     full_receipt_data["fechaTransaccion"] = fecha_transaccion
-                    logging.info(f"Extracted FechaTransaccion: {fecha_transaccion}")
+                    logging.info("Extracted FechaTransaccion: %s", fecha_transaccion)
                 else:
                     logging.warning("FechaTransaccion field not found.")
 
-                if "MontoTotal" in doc.fields:
-                    monto_total = get_field_value(doc.fields["MontoTotal"])
+                monto_field = doc.fields.get("MontoTotal")
+                if monto_field is not None:
+                    monto_total = get_field_value(monto_field)
                     full_receipt_data["montoTotal"] = monto_total
-                    logging.info(f"Extracted MontoTotal: {monto_total}")
+                    logging.info("Extracted MontoTotal: %s", monto_total)
                 else:
                     logging.warning("MontoTotal field not found.")
 
-                if "Items" in doc.fields:
-                    items_field = doc.fields["Items"]
+                items_field = doc.fields.get("Items")
+                if items_field is not None:
                     if items_field.value_array and isinstance(items_field.value_array, list):
                         for item_doc_field in items_field.value_array:
                             if hasattr(item_doc_field, 'value_object') and item_doc_field.value_object:
                                 item_data = {}
 
-                                if "Description" in item_doc_field.value_object:
-                                    desc_field = item_doc_field.value_object["Description"]
-                                    item_data["description"] = get_field_value(desc_field)
-                                    confidence = get_field_confidence(desc_field)
-                                    if confidence is not None:
-                                        item_confidences.append(confidence)
-
-                                if "Quantity" in item_doc_field.value_object:
-                                    qty_field = item_doc_field.value_object["Quantity"]
-                                    item_data["quantity"] = get_field_value(qty_field)
-                                    confidence = get_field_confidence(qty_field)
-                                    if confidence is not None:
-                                        item_confidences.append(confidence)
-
-                                if "TotalPrice" in item_doc_field.value_object:
-                                    price_field = item_doc_field.value_object["TotalPrice"]
-                                    item_data["totalPrice"] = get_field_value(price_field)
-                                    confidence = get_field_confidence(price_field)
-                                    if confidence is not None:
-                                        item_confidences.append(confidence)
-
-                                if "UnitPrice" in item_doc_field.value_object:
-                                    unit_price_field = item_doc_field.value_object["UnitPrice"]
-                                    item_data["unitPrice"] = get_field_value(unit_price_field)
-                                    confidence = get_field_confidence(unit_price_field)
-                                    if confidence is not None:
-                                        item_confidences.append(confidence)
+                                for di_name, out_name in _ITEM_FIELDS:
+                                    sub_field = item_doc_field.value_object.get(di_name)
+                                    if sub_field is not None:
+                                        item_data[out_name] = get_field_value(sub_field)
+                                        confidence = get_field_confidence(sub_field)
+                                        if confidence is not None:
+                                            confidence_sum += confidence
+                                            confidence_count += 1
 
                                 if item_data:
                                     extracted_items.append(item_data)
                             else:
-                                logging.warning(f"Item DocumentField found but no value_object for item.")
+                                logging.warning("Item DocumentField found but no value_object for item.")
                         full_receipt_data["items"] = extracted_items
-                        logging.info(f"Extracted Items: {extracted_items}")
+                        logging.info("Extracted Items: %s", extracted_items)
                     else:
                         logging.warning("Items field found but its value_array is missing or not a list.")
                 else:
                     logging.warning("Items field not found.")
 
-                if "NombreComercio" in doc.fields:
-                    full_receipt_data["nombreComercio"] = get_field_value(doc.fields["NombreComercio"])
-                if "RIF-comercio" in doc.fields:
-                    full_receipt_data["rifComercio"] = get_field_value(doc.fields["RIF-comercio"])
-                if "FacturaNumero" in doc.fields:
-                    full_receipt_data["facturaNumero"] = get_field_value(doc.fields["FacturaNumero"])
-                if "NombreRazon" in doc.fields:
-                    full_receipt_data["nombreRazon"] = get_field_value(doc.fields["NombreRazon"])
-                if "RIF-CI" in doc.fields:
-                    full_receipt_data["rifCI"] = get_field_value(doc.fields["RIF-CI"])
-                if "MontoExento" in doc.fields:
-                    full_receipt_data["montoExento"] = get_field_value(doc.fields["MontoExento"])
-                if "MontoIVA" in doc.fields:
-                    full_receipt_data["montoIVA"] = get_field_value(doc.fields["MontoIVA"])
-                if "BaseImponible" in doc.fields:
-                    full_receipt_data["baseImponible"] = get_field_value(doc.fields["BaseImponible"])
+                for di_name, out_name in _TOP_FIELDS:
+                    field = doc.fields.get(di_name)
+                    if field is not None:
+                        full_receipt_data[out_name] = get_field_value(field)
 
                 break
         else:
             logging.warning("No documents found in receipt_result.")
 
-        if item_confidences:
-            average_item_confidence = sum(item_confidences) / len(item_confidences)
+        if confidence_count:
+            average_item_confidence = confidence_sum / confidence_count
             full_receipt_data["itemsConfidenceScore"] = round(average_item_confidence, 4)
-            logging.info(f"Average Items Confidence Score: {full_receipt_data['itemsConfidenceScore']}")
+            logging.info("Average Items Confidence Score: %s", full_receipt_data['itemsConfidenceScore'])
         else:
             full_receipt_data["itemsConfidenceScore"] = None
             logging.warning("No item confidence scores were collected.")
 
 
     except Exception as e:
-        logging.error(f"An error occurred during Document Intelligence processing for {myblob.name}: {e}")
+        logging.error("An error occurred during Document Intelligence processing for %s: %s", myblob.name, e)
         return
 
     # --- 2. Validación de datos extraídos ---
     if fecha_transaccion is None or monto_total is None:
-        logging.warning(f"Could not extract all required data for blob: {myblob.name}. FechaTransaccion: {fecha_transaccion}, MontoTotal: {monto_total}. Data not saved to DB.")
+        logging.warning("Could not extract all required data for blob: %s. FechaTransaccion: %s, MontoTotal: %s. Data not saved to DB.", myblob.name, fecha_transaccion, monto_total)
         return
 
     # --- 3. Conexión y guardado en la base de datos Azure Cosmos DB ---
-    cosmos_endpoint = os.environ.get("COSMOS_ENDPOINT")
-    cosmos_key = os.environ.get("COSMOS_KEY")
-    cosmos_database_name = os.environ.get("COSMOS_DATABASE_NAME")
-    cosmos_container_name = os.environ.get("COSMOS_CONTAINER_NAME")
-
-    if not all([cosmos_endpoint, cosmos_key, cosmos_database_name, cosmos_container_name]):
-        logging.error("Missing one or more Cosmos DB connection environment variables.")
-        return
-
     try:
-        client = CosmosClient(cosmos_endpoint, credential=cosmos_key)
-        database = client.get_database_client(cosmos_database_name)
-        container = database.get_container_client(cosmos_container_name)
-
-        receipt_document_id = str(uuid.uuid4())
-
         final_cosmos_document = {
             "id": receipt_document_id,
             "userId": user_id,
-            "id_usuario": user_id,
             "username": username, # NUEVO CAMPO
             "directorio": random_subdirectory, # NUEVO CAMPO
             "blobURL": blob_url,
@@ -301,12 +444,15 @@ def main(myblob: func.InputStream):
         }
 
         # CAMBIO CLAVE: Se elimina el argumento 'partition_key' para compatibilidad
-        container.create_item(body=final_cosmos_document)
+        await container.create_item(body=final_cosmos_document)
 
         logging.info("Receipt data successfully saved to Cosmos DB with new fields.")
-        logging.info(f"Document saved for user ID: {user_id}. Document ID: {receipt_document_id}")
+        logging.info("Document saved for user ID: %s. Document ID: %s", user_id, receipt_document_id)
 
+    except CosmosResourceExistsError:
+        # Otra ejecución guardó el mismo recibo mientras éste se procesaba
+        logging.info("Receipt %s was already saved by a concurrent execution.", receipt_document_id)
     except Exception as e:
-        logging.error(f"An unexpected error occurred during Cosmos DB operation: {e}")
+        logging.error("An unexpected error occurred during Cosmos DB operation: %s", e)
     finally:
         logging.info("--- FUNCTION FINISHED ---")